@@ -0,0 +1,14 @@
+-- Indexes for time-window and per-route reads of vehicle_snapshots.
+--
+-- Rows are appended in timestamp order, so a BRIN index covers time-range
+-- filters for a fraction of the size of a btree. The composite btree serves
+-- "latest positions for route X" lookups without a re-sort.
+--
+-- CONCURRENTLY cannot run inside a transaction block; apply with plain psql:
+--   psql -h localhost -U myuser -d abq_transit -f migrations/001_vehicle_snapshots_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS vs_ts_idx
+    ON vehicle_snapshots USING brin (timestamp_collected);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS vs_route_ts
+    ON vehicle_snapshots (route_short_name, timestamp_collected DESC);
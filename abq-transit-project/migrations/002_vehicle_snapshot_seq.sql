@@ -0,0 +1,34 @@
+-- Sequence for per-snapshot ids, drawn once per insert by the collector.
+--
+-- Replaces deriving ids on the client (SELECT MAX(snapshot_id) + 1, or a
+-- loop counter that restarts at 1 on every run), which scans the table and
+-- collides across runs. Seeded past the existing ids so history is kept.
+--
+-- Safe to re-run: the sequence is only ever moved forward, past its own
+-- position, every vehicle_snapshots.snapshot_id and (once 003 has been
+-- applied) every snapshots.id.
+--   psql -h localhost -U myuser -d abq_transit -f migrations/002_vehicle_snapshot_seq.sql
+
+CREATE SEQUENCE IF NOT EXISTS vehicle_snapshot_seq;
+
+DO $$
+DECLARE
+    next_id bigint;
+BEGIN
+    SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END
+    INTO next_id
+    FROM vehicle_snapshot_seq;
+
+    next_id := GREATEST(
+        next_id, (SELECT COALESCE(MAX(snapshot_id), 0) + 1 FROM vehicle_snapshots)
+    );
+
+    IF to_regclass('snapshots') IS NOT NULL THEN
+        EXECUTE 'SELECT GREATEST($1, COALESCE(MAX(id), 0) + 1) FROM snapshots'
+        INTO next_id
+        USING next_id;
+    END IF;
+
+    PERFORM setval('vehicle_snapshot_seq', next_id, false);
+END
+$$;
@@ -0,0 +1,44 @@
+-- One row per collected snapshot; vehicle_snapshots.snapshot_id references it.
+--
+-- The collector inserts the snapshot row and its vehicles in one statement,
+-- so the snapshot timestamp is sent once per tick instead of once per vehicle.
+-- vehicle_snapshots keeps its own timestamp_collected column for existing
+-- readers and the BRIN index from 001.
+--
+-- Rollout: once the foreign key below exists, every insert into
+-- vehicle_snapshots must reference an existing snapshots row. Writers that
+-- do not create one first (including earlier versions of the collector,
+-- which send their own snapshot_id) will fail on every insert. Stop old
+-- collectors before applying this file and deploy the current one with it.
+--   psql -h localhost -U myuser -d abq_transit -f migrations/003_snapshots.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS snapshots (
+    id                  bigint PRIMARY KEY DEFAULT nextval('vehicle_snapshot_seq'),
+    timestamp_collected timestamptz NOT NULL,
+    source              text
+);
+
+ALTER SEQUENCE vehicle_snapshot_seq OWNED BY snapshots.id;
+
+-- Backfill the ids already in use so the foreign key holds for history too.
+-- Older collector runs reused ids 1..N on every start, so one id can span many
+-- runs; these rows are placeholders (source = 'backfill'), not real snapshot
+-- metadata, and their timestamp is only the earliest seen for that id.
+-- Use vehicle_snapshots.timestamp_collected for historical rows.
+INSERT INTO snapshots (id, timestamp_collected, source)
+SELECT snapshot_id, MIN(timestamp_collected), 'backfill'
+FROM vehicle_snapshots
+WHERE snapshot_id IS NOT NULL
+GROUP BY snapshot_id
+ON CONFLICT (id) DO NOTHING;
+
+-- NOT VALID skips the full-table check while holding the lock; validated below
+ALTER TABLE vehicle_snapshots
+    ADD CONSTRAINT vehicle_snapshots_snapshot_id_fkey
+    FOREIGN KEY (snapshot_id) REFERENCES snapshots (id) NOT VALID;
+
+COMMIT;
+
+ALTER TABLE vehicle_snapshots VALIDATE CONSTRAINT vehicle_snapshots_snapshot_id_fkey;
@@ -1,10 +1,17 @@
+import csv
+import io
+import math
 import os
+import queue
+import threading
 import time
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import psycopg2
-from psycopg2 import sql
-from datetime import datetime
+from psycopg2 import errors
+from datetime import datetime, timezone
 
 # --- Database Connection Function ---
 def connect_to_db():
@@ -18,45 +25,207 @@ def connect_to_db():
     # Retry connection to give the database time to initialize
     retries = 5
     while retries > 0:
+        conn = None
         try:
             conn = psycopg2.connect(
                 dbname=db_name, user=db_user, password=db_password, host=db_host
             )
             print("✅ Database connection successful.")
+            prepare_statements(conn)
             return conn
+        except (errors.UndefinedTable, errors.UndefinedObject) as e:
+            # vs_insert needs vehicle_snapshot_seq and snapshots from the migrations
+            conn.close()
+            print(f"❌ Could not prepare statements; apply migrations 002 and 003 first. ({e})")
+            return None
         except psycopg2.OperationalError as e:
+            if conn is not None:
+                conn.close()
             retries -= 1
             print(f"⏳ Database not ready, waiting... ({e})")
             time.sleep(5)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            raise
     return None
 
+def recover_connection(conn):
+    """Rolls back a failed load, or reopens the connection if it was dropped."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            pass
+
+    # Drop the old session (and its temp table and prepared statement) if it is still open
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+    print("🔌 Database connection lost, reconnecting...")
+    new_conn = connect_to_db()
+    if not new_conn:
+        # Keep the closed connection; later loads fail and retry the reconnect
+        print("❌ Reconnect failed; will retry on the next snapshot.")
+        return conn
+    return new_conn
+
 # --- Data Insertion Function ---
-def insert_data(conn, df):
-    """Inserts a DataFrame of vehicle data into the database."""
+INSERT_COLUMNS = [
+    'vehicle_id', 'longitude', 'latitude', 'heading', 'speed_mph',
+    'route_short_name', 'trip_id', 'next_stop_id', 'next_stop_name',
+    'next_stop_sched_time'
+]
+
+# Created once per connection; ON COMMIT DELETE ROWS empties it after every snapshot.
+# Column types are copied from vehicle_snapshots itself so the merge below never needs
+# a cast; only the coordinates, which the target stores as one geometry, are declared.
+CREATE_STAGE_QUERY = """
+    CREATE TEMP TABLE vs_stage ON COMMIT DELETE ROWS AS
+    SELECT
+        vehicle_id, NULL::float8 AS longitude, NULL::float8 AS latitude,
+        heading, speed_mph, route_short_name, trip_id,
+        next_stop_id, next_stop_name, next_stop_sched_time
+    FROM vehicle_snapshots
+    WITH NO DATA;
+"""
+
+# Planned once per connection; merges the staged rows and builds the points server-side.
+# Each EXECUTE records one row in snapshots (migration 003), whose id and timestamp
+# are then stamped onto every staged vehicle instead of being sent per row.
+PREPARE_INSERT_QUERY = """
+    PREPARE vs_insert (timestamptz, text) AS
+    WITH snapshot AS (
+        INSERT INTO snapshots (timestamp_collected, source)
+        VALUES ($1, $2)
+        RETURNING id, timestamp_collected
+    )
+    INSERT INTO vehicle_snapshots (
+        snapshot_id, timestamp_collected, vehicle_id, location,
+        heading, speed_mph, route_short_name, trip_id,
+        next_stop_id, next_stop_name, next_stop_sched_time
+    )
+    SELECT
+        snapshot.id, snapshot.timestamp_collected, vehicle_id,
+        ST_SetSRID(ST_MakePoint(longitude, latitude), 4326),
+        heading, speed_mph, route_short_name, trip_id,
+        next_stop_id, next_stop_name, next_stop_sched_time
+    FROM vs_stage CROSS JOIN snapshot
+    ON CONFLICT DO NOTHING;
+"""
+
+# Explicit NULL marker so empty strings from the feed stay '' instead of loading as NULL
+COPY_STAGE_QUERY = f"COPY vs_stage ({', '.join(INSERT_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+def prepare_statements(conn):
+    """Creates the staging table and prepares the snapshot INSERT on a freshly opened connection."""
+    with conn.cursor() as cur:
+        cur.execute(CREATE_STAGE_QUERY)
+        cur.execute(PREPARE_INSERT_QUERY)
+    conn.commit()
+
+def insert_data(conn, rows, timestamp_collected, source):
+    """Inserts one snapshot's vehicle row tuples into the database via COPY into the staging table."""
+    # Only real nulls become NULL; None is written as the \N marker
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerows(
+        tuple('\\N' if value is None else value for value in row) for row in rows
+    )
+    buf.seek(0)
+
     with conn.cursor() as cur:
-        for _, row in df.iterrows():
-            insert_query = sql.SQL("""
-                INSERT INTO vehicle_snapshots (
-                    snapshot_id, timestamp_collected, vehicle_id, location,
-                    heading, speed_mph, route_short_name, trip_id,
-                    next_stop_id, next_stop_name, next_stop_sched_time
-                ) VALUES (
-                    %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s, %s, %s, %s, %s, %s, %s
-                ) ON CONFLICT DO NOTHING;
-            """)
-            
-            # Handle potential null values for time
-            next_stop_time = row['next_stop_sched_time'] if pd.notna(row['next_stop_sched_time']) else None
-
-            cur.execute(insert_query, (
-                row['snapshot_id'], row['timestamp_collected'], row['vehicle_id'],
-                row['longitude'], row['latitude'], row['heading'], row['speed_mph'],
-                row['route_short_name'], row['trip_id'], row['next_stop_id'],
-                row['next_stop_name'], next_stop_time
-            ))
+        cur.copy_expert(COPY_STAGE_QUERY, buf)
+        cur.execute("EXECUTE vs_insert (%s, %s);", (timestamp_collected, source))
     conn.commit()
-    print(f"✅ Inserted {len(df)} records into the database.")
+    print(f"✅ Inserted {len(rows)} records into the database.")
+
+# --- Feed Parsing Function ---
+def parse_feed(content):
+    """Parses the raw feed bytes, falling back to ISO-8859-1 if they are not valid UTF-8."""
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return orjson.loads(content.decode("iso-8859-1"))
+
+# --- Feed Fetching Function ---
+# (connect, read) seconds per attempt
+REQUEST_TIMEOUT = (3.05, 5)
+
+# Retry transient upstream failures within the tick instead of losing the snapshot.
+# Worst case is 3 attempts x 8 s plus ~1.5 s of capped, jittered backoff, so a fetch
+# stays inside one 30 s tick; Retry-After is ignored so a 429 cannot stall the producer.
+RETRY_POLICY = Retry(
+    total=2, backoff_factor=0.4, backoff_max=2, backoff_jitter=0.1,
+    status_forcelist=[429, 502, 503, 504], allowed_methods=["GET"],
+    respect_retry_after_header=False
+)
+
+# One keep-alive session for the life of the collector, only used by the fetch worker
+SESSION = requests.Session()
+SESSION.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': 'abq-transit-collector/1.0'})
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=RETRY_POLICY))
+
+def fetch_feed(url, not_before):
+    """Waits until the scheduled tick, then fetches and parses one feed snapshot."""
+    delay = not_before - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    data = parse_feed(response.content)
+    # Timezone-aware, so psycopg2 sends an unambiguous timestamptz
+    timestamp_collected = datetime.now(timezone.utc)
+    return data, timestamp_collected
+
+def produce_snapshots(url, num_snapshots, interval, snapshots):
+    """Fetches the feed on a fixed schedule and queues each snapshot for loading."""
+    start = time.monotonic()
+    for i in range(num_snapshots):
+        try:
+            data, timestamp_collected = fetch_feed(url, start + i * interval)
+            snapshots.put((i, data, timestamp_collected))
+        except Exception as e:
+            print(f"❌ Error fetching snapshot {i+1}: {e}")
+
+    # Tell the consumer there is nothing more to load
+    snapshots.put(None)
+
+# --- Record Building Function ---
+def build_snapshot(vehicles):
+    """Builds row tuples (in INSERT_COLUMNS order) for the valid vehicles in the raw feed."""
+    rows = []
+    for vehicle in vehicles:
+        g = vehicle.get
+        vehicle_id = g("vehicle_id")
+        if vehicle_id is None:
+            continue
+
+        # Skip vehicles that cannot be placed on the map
+        try:
+            latitude, longitude = float(g("latitude")), float(g("longitude"))
+        except (TypeError, ValueError):
+            continue
+        if not (math.isfinite(latitude) and math.isfinite(longitude)):
+            continue
+
+        rows.append((
+            vehicle_id, longitude, latitude, g("heading"), g("speed_mph"),
+            g("route_short_name"), g("trip_id"), g("next_stop_id"),
+            g("next_stop_name"), g("next_stop_sched_time") or None
+        ))
+    return rows
+
+# Off by default: the notebooks' stuck-vehicle, repeated-point and jump/gap
+# detectors rely on every vehicle reporting on every tick
+SKIP_UNCHANGED_ROWS = os.getenv('SKIP_UNCHANGED_ROWS', '').lower() in ('1', 'true', 'yes')
+
+def drop_unchanged(rows, last_state):
+    """Drops rows identical to the last row stored for the same vehicle (e.g. parked buses)."""
+    return [row for row in rows if last_state.get(row[0]) != row[1:]]
 
 # --- Main Application Logic ---
 def main():
@@ -71,40 +240,46 @@ def main():
 
     print(f"🚍 Starting Albuquerque data collection ({NUM_SNAPSHOTS} snapshots)...")
 
-    for i in range(NUM_SNAPSHOTS):
+    # Fetching runs on its own thread so a slow insert never delays a tick; the
+    # bounded queue only holds the producer back if loading falls well behind
+    snapshots = queue.Queue(maxsize=4)
+    producer = threading.Thread(
+        target=produce_snapshots, args=(GTFS_URL, NUM_SNAPSHOTS, SLEEP_SECONDS, snapshots), daemon=True
+    )
+    producer.start()
+
+    # Last stored row (minus vehicle_id) per vehicle, used to skip repeats when enabled
+    last_state = {}
+
+    while True:
+        item = snapshots.get()
+        if item is None:
+            break
+        i, data, timestamp_collected = item
+
         try:
-            print(f"\n📸 Snapshot {i+1}/{NUM_SNAPSHOTS} at {datetime.now().strftime('%H:%M:%S')}")
-            
-            # Fetch data from the URL
-            response = requests.get(GTFS_URL)
-            data = response.json()
-            timestamp_collected = datetime.utcnow().isoformat()
-            
-            # Process records into a DataFrame
-            records = []
-            for vehicle in data.get("allroutes", []):
-                records.append({
-                    "snapshot_id": i + 1, "timestamp_collected": timestamp_collected,
-                    "vehicle_id": vehicle.get("vehicle_id"), "latitude": vehicle.get("latitude"),
-                    "longitude": vehicle.get("longitude"), "heading": vehicle.get("heading"),
-                    "speed_mph": vehicle.get("speed_mph"), "route_short_name": vehicle.get("route_short_name"),
-                    "trip_id": vehicle.get("trip_id"), "next_stop_id": vehicle.get("next_stop_id"),
-                    "next_stop_name": vehicle.get("next_stop_name"),
-                    "next_stop_sched_time": vehicle.get("next_stop_sched_time")
-                })
-            df_snapshot = pd.DataFrame(records)
+            print(f"\n📸 Snapshot {i+1}/{NUM_SNAPSHOTS} at {timestamp_collected.strftime('%H:%M:%S')} UTC")
 
-            # Insert the new data into the database
-            if not df_snapshot.empty:
-                insert_data(conn, df_snapshot)
+            # Process records into row tuples
+            rows = build_snapshot(data.get("allroutes", []))
+            if SKIP_UNCHANGED_ROWS:
+                rows = drop_unchanged(rows, last_state)
+                if not rows:
+                    print("⏸️ No vehicle changes since the last snapshot.")
 
-            if i < NUM_SNAPSHOTS - 1:
-                time.sleep(SLEEP_SECONDS)
+            # Insert the new data into the database
+            if rows:
+                insert_data(conn, rows, timestamp_collected, GTFS_URL)
+                if SKIP_UNCHANGED_ROWS:
+                    last_state.update((row[0], row[1:]) for row in rows)
 
         except Exception as e:
             print(f"❌ Error during snapshot {i+1}: {e}")
+            # Clear the failed transaction so the next snapshot can still load
+            conn = recover_connection(conn)
             continue
-    
+
+    producer.join()
     conn.close()
     print("\n🎉 Data collection and loading complete.")
 